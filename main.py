@@ -1,8 +1,11 @@
+import array
+import collections
+import concurrent.futures
 import configparser
+import itertools
+import os
 import sys
 import signal
-import re
-import copy
 
 CONFIG_PATH = 'config.ini'
 # global flag for stopping program by SIGINT (CTRL+C on Linux)
@@ -16,12 +19,47 @@ STUCK = 'stuck' # not finished, but cannot continue
 CLOSED = 'closed'
 # }}}
 
+# CONTIGS {{{
+class Contig:
+    # __slots__: no per-instance dict, which matters with many branched contigs
+    __slots__ = ('status', 'parts', 'length')
+
+    def __init__(self, status, parts, length):
+        self.status = status
+        self.parts = parts # immutable chunks, joined lazily
+        self.length = length
+
+    def append(self, chunk):
+        """extend the contig without recopying the sequence"""
+        self.parts.append(chunk)
+        self.length += len(chunk)
+
+    def text(self):
+        """full sequence; collapses the parts list to a single chunk"""
+        parts = self.parts
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if len(parts) > 0 else ''
+
+    def tail(self, length):
+        """last `length` characters, joining only as many trailing parts as needed"""
+        chunks = []
+        got = 0
+        for part in reversed(self.parts):
+            chunks.append(part)
+            got += len(part)
+            if got >= length:
+                break
+        return "".join(reversed(chunks))[-length:]
+# }}}
+
 def defaultConfig():
     config = configparser.ConfigParser()
     config['PATHS'] = {'database_path': 'database.fa',
                        'supercontigs_path': 'supercontigs.txt',
                        'supercontigs_output_path': 'supercontigs_output.txt'}
-    config['SEARCHER'] = {}
+    config['SEARCHER'] = {'index_seed_length': '12',
+                          'index_workers': '0'} # 0 means one per CPU
     config['ENHANCER'] = {'max_contig_length': '80000',
                           'max_suffix_length': '50',
                           'min_suffix_length': '30',
@@ -45,30 +83,25 @@ def verifyConfig(config):
 class Supercontigs:
     def __init__(self, config):
         self.config = config
-        self.csp = re.compile('^\\s*$') # only whitespace characters
-        self.op = re.compile('([ACGT]{'+ 
-                        self.config['overlapping_min']
-                        + ',' + 
-                        self.config['overlapping_max']
-                        + '})\#\\1') # overlapping abc#abc
+        self.overlap_lo = int(config['overlapping_min'])
+        self.overlap_hi = int(config['overlapping_max'])
 
     def read(self, filename):
         def is_comment(s):
-            return len(s) > 0 and s[0] == '#'
+            return s.startswith('#')
 
         def is_status(s):
-            return len(s) > 0 and s[0] == '@'
-        
+            return s.startswith('@')
+
         def status(s):
             if is_status(s): return s[1:]
             raise Exception
 
         def is_contig_separator(s):
-            nonlocal self
-            return self.csp.match(s) is not None
-       
+            return not s or s.isspace()
+
         def is_supercontig_separator(s):
-            return len(s) >= 5 and s[:5] == "-----"
+            return s.startswith("-----")
         
 
         print("reading supercontigs from '{}'".format(filename))
@@ -117,67 +150,201 @@ class Supercontigs:
             sys.exit(1)
         
         # add status for every contig and supercontig
-        self.array = [{'status':sc['status'], 
-                       'content':[ {'status':OPEN, 'content':contig} for contig in sc['content']]
+        self.array = [{'status':sc['status'],
+                       'content':[ Contig(OPEN, [contig], len(contig)) for contig in sc['content']]
                       } for sc in self.array]
 
+        self.rebuild_head_index()
+
+    def _head_key(self, supercontig):
+        if len(supercontig['content']) == 0: return None
+        head = supercontig['content'][0].text()
+        if len(head) < self.overlap_lo: return None
+        return head[:self.overlap_lo]
+
+    def _register_head(self, i):
+        key = self._head_key(self.array[i])
+        self.head_keys[i] = key
+        if key is not None:
+            self.head_index.setdefault(key, set()).add(i)
+
+    def rebuild_head_index(self):
+        # head_index maps the first overlap_lo characters of each
+        # supercontig head to the supercontig indices carrying that head
+        self.head_index = {}
+        self.head_keys = [None] * len(self.array)
+        for i in range(len(self.array)):
+            self._register_head(i)
+
+    def refresh_head(self, i):
+        """re-register supercontig i after its content list changed"""
+        old_key = self.head_keys[i]
+        if old_key is not None:
+            group = self.head_index.get(old_key)
+            if group is not None:
+                group.discard(i)
+                if len(group) == 0:
+                    del self.head_index[old_key]
+        self._register_head(i)
+
     def write(self, filename):
         print("writing supercontigs to '{}'".format(filename))
         linebreaker = int(self.config['linebreak_at'])
+        parts = []
+        for supercontig in self.array:
+            parts.append("-----\n")
+            if supercontig['status'] != OPEN: parts.append("@{}\n".format(supercontig['status']))
+            for contig in supercontig['content']:
+                parts.append(" \n")
+                content = contig.text()
+                for i in range(0, len(content), linebreaker):
+                    parts.append(content[i:i+linebreaker])
+                    parts.append("\n")
         try:
-            f = open(filename, 'w')
-            for supercontig in self.array:
-                print("-----", file=f)
-                if supercontig['status'] != OPEN: print("@{}".format(supercontig['status']), file=f)
-                for contig in supercontig['content']:
-                    print(" ", file=f)
-                    for i in range(0, len(contig['content']), linebreaker):
-                        print(contig['content'][i:i+linebreaker], file=f)
+            f = open(filename, 'w', buffering=1<<20)
+            f.writelines(parts)
             f.close()
         except IOError as err:
             print(err)
             sys.exit(1)
 
     def is_overlapping_contig(self, contig):
-        for supercontig in self.array:
-            if len(supercontig['content']) > 0:
-                if self.op.match(contig['content'] + '#' + supercontig['content'][0]['content']) is not None:
+        tail = contig.tail(self.overlap_hi)
+        for length in range(self.overlap_lo, min(self.overlap_hi, len(tail)) + 1):
+            # an overlap of this length starts with these overlap_lo characters
+            key = tail[len(tail)-length : len(tail)-length+self.overlap_lo]
+            for i in self.head_index.get(key, ()):
+                head = self.array[i]['content'][0].text()
+                if length <= len(head) and tail[-length:] == head[:length]:
                     return True
         return False
 
+def _index_shard(reads, offsets, seed_length):
+    """build a partial seed index for one shard of reads (runs in a worker)"""
+    # positions live in flat arrays of machine words instead of lists of
+    # boxed Python ints: an eighth of the memory and contiguous to walk
+    index = {}
+    for read, offset in zip(reads, offsets):
+        for i in range(len(read) - seed_length + 1):
+            positions = index.get(read[i:i+seed_length])
+            if positions is None:
+                positions = index[read[i:i+seed_length]] = array.array('q')
+            positions.append(offset + i)
+    return index
+
+
 class Searcher:
+    # separates reads inside the concatenated database blob; not part of
+    # ACGT, and successor windows containing it are skipped explicitly
+    SEPARATOR = b'\n'
+    # how many (suffix, successor_length) query results to remember
+    MEMO_LIMIT = 10000
+
     def __init__(self, config):
         self.config = config
-    
+        self._memo = {}
+
     def read_database(self, filename):
         print("reading database from '{}' (could take a while)".format(filename))
         try:
-            f = open(filename, 'r')
-            self.database = []
-            current_read = []
-            for line in f.read().splitlines():
-                if line[0] == '>':
-                    self.database.append("".join(current_read))
-                    current_read = []
-                else:
-                    current_read.append(line)
-            self.database.append("".join(current_read))
+            # one bulk read, one split on the record separator, one newline
+            # strip per record; all C-level passes over the buffer
+            f = open(filename, 'rb')
+            raw = f.read()
             f.close()
+
+            # the leading separator makes the chunk before the first header
+            # a record like any other (it may be empty, as before)
+            records = (b'\n' + raw).split(b'\n>')
+            # delete \r as well so CRLF input parses like it did line by line
+            self.database = [records[0].translate(None, delete=b'\r\n').upper()]
+            for record in records[1:]:
+                nl = record.find(b'\n')
+                body = record[nl+1:] if nl >= 0 else b''
+                self.database.append(body.translate(None, delete=b'\r\n').upper())
         except IOError as err:
             print(err)
             sys.exit(1)
 
-    def find_successors(self, suffix, successor_length):
-        pattern = re.compile(suffix + '(.{' + str(successor_length) + '})', re.IGNORECASE)
-        print(pattern)
-        successors = {}
+        self.build_index()
+
+    def build_index(self):
+        print("indexing database (could take a while)")
+        self._memo = {}
+        seed_length = int(self.config['index_seed_length'])
+        self.seed_length = seed_length
+        self.blob = self.SEPARATOR.join(self.database)
+
+        offsets = []
+        offset = 0
         for read in self.database:
-            matched = pattern.findall(read)
-            for succ in matched:
-                if succ not in successors:
-                    successors[succ] = 0
-                successors[succ] += 1
-        return successors
+            offsets.append(offset)
+            offset += len(read) + 1 # +1 for the separator
+
+        workers = int(self.config['index_workers']) or os.cpu_count() or 1
+        if workers <= 1 or len(self.database) < workers * 16:
+            # not worth the pool overhead for small databases
+            self.index = _index_shard(self.database, offsets, seed_length)
+            return
+
+        shard_size = -(-len(self.database) // workers)
+        shards = [self.database[i:i+shard_size] for i in range(0, len(self.database), shard_size)]
+        shard_offsets = [offsets[i:i+shard_size] for i in range(0, len(offsets), shard_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_index_shard, shards, shard_offsets,
+                                      itertools.repeat(seed_length)))
+        # shards are processed in order, so positions stay sorted per seed
+        self.index = parts[0]
+        for part in parts[1:]:
+            for seed, positions in part.items():
+                existing = self.index.get(seed)
+                if existing is None:
+                    self.index[seed] = positions
+                else:
+                    existing.extend(positions)
+
+    def find_successors(self, suffix, successor_length):
+        suffix = suffix.upper().encode('ascii')
+        # branched contigs share their parent's tail, so queries repeat
+        key = (suffix, successor_length)
+        cached = self._memo.get(key)
+        if cached is not None:
+            return cached
+        if len(suffix) < self.seed_length:
+            counts = self._find_successors_scan(suffix, successor_length)
+        else:
+            blob = self.blob
+            suffix_length = len(suffix)
+            matched = []
+            for position in self.index.get(suffix[:self.seed_length], []):
+                if blob[position:position+suffix_length] != suffix:
+                    continue
+                succ = blob[position+suffix_length:position+suffix_length+successor_length]
+                if len(succ) == successor_length and self.SEPARATOR not in succ:
+                    matched.append(succ)
+            counts = collections.Counter(matched)
+        # decode only the few distinct successors back to str for the enhancer
+        result = collections.Counter({succ.decode('ascii'): count for succ, count in counts.items()})
+        if len(self._memo) >= self.MEMO_LIMIT:
+            # drop the oldest entry; dicts iterate in insertion order
+            self._memo.pop(next(iter(self._memo)))
+        self._memo[key] = result
+        return result
+
+    def _find_successors_scan(self, suffix, successor_length):
+        """fallback for suffixes shorter than the index seed"""
+        blob = self.blob
+        find = blob.find
+        suffix_length = len(suffix)
+        matched = []
+        position = find(suffix)
+        while position >= 0:
+            start = position + suffix_length
+            succ = blob[start:start+successor_length]
+            if len(succ) == successor_length and self.SEPARATOR not in succ:
+                matched.append(succ)
+            position = find(suffix, position + 1)
+        return collections.Counter(matched)
 
 
 class Enhancer:
@@ -185,7 +352,35 @@ class Enhancer:
         self.supercontigs = supercontigs
         self.searcher = searcher
         self.config = config
-    
+        # parse the config once; the loops below run millions of times
+        self.max_contig_length = int(config['max_contig_length'])
+        self.suffix_lengths = range(int(config['max_suffix_length']),
+                                    int(config['min_suffix_length']) - 1,
+                                    -int(config['suffix_length_step']))
+        self.successor_length = int(config['successor_length'])
+        self.definitive_threshold = float(config['definitive_successor_threshold'])
+        self.definitive_total_min = int(config['definitive_successor_total_min'])
+        self.branching_threshold = float(config['branching_successor_threshold'])
+        self.branching_total_min = int(config['branching_successor_total_min'])
+        self.branching_max_count = max(1, int(config['branching_successor_max_count']))
+        self.max_contig_amount = int(config['max_contig_amount'])
+
+
+    def pick_successors(self, successors):
+        """one pass over a query result: (definitive, None), (None, branching
+        candidates) or (None, None) when the contig cannot be extended"""
+        top = successors.most_common(self.branching_max_count)
+        if len(top) == 0:
+            return None, None
+        total = sum(successors.values())
+        if total >= self.definitive_total_min and top[0][1]/total >= self.definitive_threshold:
+            return top[0][0], None
+        if total >= self.branching_total_min:
+            branching = [succ for (succ, count) in top if count/total >= self.branching_threshold]
+            if len(branching) > 1:
+                return None, branching
+        return None, None
+
     def start(self):
         for i in range(len(self.supercontigs.array)):
             if isStopped: return
@@ -193,85 +388,63 @@ class Enhancer:
             if supercontig['status'] != OPEN: continue
             print("supercontig number {}".format(i))
             
-            stack = [x for x in supercontig['content'] if x['status'] == OPEN]
-            supercontig['content'] = [x for x in supercontig['content'] if x['status'] != OPEN]
-            
+            stack = [x for x in supercontig['content'] if x.status == OPEN]
+            supercontig['content'] = [x for x in supercontig['content'] if x.status != OPEN]
+            self.supercontigs.refresh_head(i)
+
             total_contig_count = len(stack) + len(supercontig['content'])
 
             while len(stack) > 0:
                 if isStopped: break
                 contig = stack[-1]
                 if self.supercontigs.is_overlapping_contig(contig):
-                    contig['status'] = OVERLAPPING
+                    contig.status = OVERLAPPING
                 
-                if len(contig['content']) > int(self.config['max_contig_length']):
-                    contig['status'] = TOO_LONG
+                if contig.length > self.max_contig_length:
+                    contig.status = TOO_LONG
 
-                if contig['status'] != OPEN:
+                if contig.status != OPEN:
                     stack.pop()
                     supercontig['content'].append(contig)
+                    if len(supercontig['content']) == 1:
+                        self.supercontigs.refresh_head(i)
                     continue
                 
                 enhanced = False
-                for suffix_length in range(int(self.config['max_suffix_length']), 
-                                           int(self.config['min_suffix_length'])-1,
-                                           -int(self.config['suffix_length_step'])):
+                for suffix_length in self.suffix_lengths:
                     if isStopped: break
-                    successors = self.searcher.find_successors(contig['content'][-suffix_length:], 
-                                                               int(self.config['successor_length']))
-                    
-                    successors = sorted([(y,x) for (x,y) in successors.items()])[::-1]
-                    print(successors)
-                    def definitive_successor(successors, threshold, total_minimum):
-                        """successors are sorted!! (reversed)"""
-                        if len(successors) == 0: return None
-                        total = sum([a for (a,b) in successors])
-                        if total < total_minimum: return None
-                        if successors[0][0]/total >= threshold:
-                            return successors[0][1]
-                        else:
-                            return None
-                        
-                    candidate = definitive_successor(successors,
-                                                     float(self.config['definitive_successor_threshold']),
-                                                     int(self.config['definitive_successor_total_min'])
-                                                     )
+                    successors = self.searcher.find_successors(contig.tail(suffix_length),
+                                                               self.successor_length)
+
+                    candidate, branching_candidates = self.pick_successors(successors)
+
                     if candidate != None:
                         print("definitive candidate found!")
-                        contig['content'] += candidate
+                        contig.append(candidate)
                         enhanced = True
                         break
 
-                    def branching_successors(successors, threshold, total_minimum, max_count):
-                        """successors are sorted!!! (reversed)"""
-                        if len(successors) == 0: return None
-                        total = sum([a for (a,b) in successors])
-                        if total < total_minimum: return None
-                        return [b for (a,b) in successors if a/total >= threshold][:max_count]
-                
-                    branching_candidates = branching_successors(
-                                            successors,
-                                            float(self.config['branching_successor_threshold']),
-                                            int(self.config['branching_successor_total_min']),
-                                            int(self.config['branching_successor_max_count'])
-                                           )
-                    if branching_candidates != None and len(branching_candidates) > 1:
+                    if branching_candidates != None:
                         print("branching candidates found!")
                         enhanced = True
-                        config = stack.pop()
+                        stack.pop()
                         total_contig_count -= 1
                         for successor in branching_candidates:
-                            if total_contig_count >= int(self.config['max_contig_amount']): break
-                            new_contig = copy.deepcopy(contig)
-                            new_contig['content'] += successor
+                            if total_contig_count >= self.max_contig_amount: break
+                            # parts are immutable strings, so the branches can share
+                            # them; only the list itself needs to be copied
+                            new_contig = Contig(contig.status,
+                                                contig.parts + [successor],
+                                                contig.length + len(successor))
                             stack.append(new_contig)
                             total_contig_count += 1
+                        break
 
-                    
                 if not enhanced:
-                    contig['status'] = STUCK
+                    contig.status = STUCK
                     continue
             supercontig['content'] += stack
+            self.supercontigs.refresh_head(i)
 
 def main():
     print("Halo, mein lieber Freund :)")